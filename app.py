@@ -1,11 +1,52 @@
 import streamlit as st
 import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
 from openai import AzureOpenAI
-from oracle_utils import get_bom_structure, get_latest_purchase_orders
+from oracle_utils import get_bom_structure, get_latest_purchase_orders_bulk
+
+LLM_MODEL = "gpt-4o-pib"
+LLM_TEMPERATURE = 0
+
+# Files/Batches live at the resource root; batch requests must name a Global-Batch deployment
+AZURE_RESOURCE_ENDPOINT = "https://askdaviddemo4082360630.openai.azure.com/"
+AZURE_BATCH_API_VERSION = "2024-10-21"
+LLM_BATCH_MODEL = os.getenv("AZURE_BATCH_DEPLOYMENT", "gpt-4o-batch")
+
+# Cap on concurrent Azure completions to stay within deployment rate limits
+LLM_MAX_CONCURRENCY = 10
+
+# Seconds between placeholder refreshes while analyses stream in
+STREAM_REFRESH_INTERVAL = 0.2
+
+# How long a search waits on a submitted batch before leaving it to "Check batch results"
+BATCH_POLL_TIMEOUT = 120
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Wide PO columns filled from each component's latest 3 purchase orders
+PO_FIELDS = {"po_number": "PO {}", "last_receipt_date": "PO Date {}", "last_unit_price": "Unit Price {}"}
+PO_COLUMNS = [name.format(i) for i in range(1, 4) for name in PO_FIELDS.values()]
+PO_FIELD_DTYPES = {"po_number": "object", "last_receipt_date": "datetime64[ns]", "last_unit_price": "float64"}
+PO_COLUMN_DTYPES = {name.format(i): PO_FIELD_DTYPES[field] for i in range(1, 4) for field, name in PO_FIELDS.items()}
+
+# Cost analyses are reused for a day, across sessions via the SQLite file
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_TTL = 86400
+
+# Seconds a fetched BOM / PO result is reused before Oracle is queried again
+ORACLE_CACHE_TTL = 3600
 
 # --- Setup ---
+@st.cache_resource(show_spinner=False)
 def setup_azure_openai_client():
+    """Shared client so every LLM call reuses the same HTTP connection pool."""
     try:
         return AzureOpenAI(
             azure_endpoint="https://askdaviddemo4082360630.openai.azure.com/openai/deployments/gpt-4o/chat/completions?api-version=2024-08-01-preview",
@@ -16,59 +57,91 @@ def setup_azure_openai_client():
         print("Failed to setup Azure OpenAI client:", e)
         return None
 
+@st.cache_resource(show_spinner=False)
+def setup_azure_batch_client():
+    """Client for the Files and Batches APIs, which the deployment-scoped endpoint cannot reach."""
+    return AzureOpenAI(
+        azure_endpoint=AZURE_RESOURCE_ENDPOINT,
+        api_key=os.getenv("AZURE_API_KEY_NEW"),
+        api_version=AZURE_BATCH_API_VERSION,
+    )
+
+# --- Cached Oracle Queries ---
+@st.cache_data(ttl=ORACLE_CACHE_TTL, show_spinner=False)
+def get_bom_structure_cached(item_number):
+    return get_bom_structure(item_number)
+
+@st.cache_data(ttl=ORACLE_CACHE_TTL, show_spinner=False)
+def get_latest_purchase_orders_cached(item_numbers):
+    return get_latest_purchase_orders_bulk(list(item_numbers))
+
 # --- Helper Functions ---
-def normalize_component(comp: str) -> str:
-    return comp.strip().replace("-  ", "").lstrip("-").strip()
+def normalize_component(comp: pd.Series) -> pd.Series:
+    return comp.astype(str).str.strip().str.replace("-  ", "", regex=False).str.lstrip("-").str.strip()
 
-def estimate_percentage(row):
-    return "8%" if row["B/M"] == "Make" else "15%" if row["B/M"] == "Buy" else ""
+def estimate_percentage(df):
+    return np.select([df["B/M"].eq("Make"), df["B/M"].eq("Buy")], ["8%", "15%"], default="")
 
-def highlight_extended_cost_level_1(row):
-    if row["Level"] == 1:
-        return ['background-color: lightblue' if col == "Extended Cost" else '' for col in row.index]
-    elif row["Level"] == 0:
-        return ['background-color: yellow' if col == "Extended Cost" else '' for col in row.index]
-    else:
-        return ['' for _ in row]
+def highlight_extended_cost_level_1(df):
+    styles = pd.DataFrame("", index=df.index, columns=df.columns)
+    styles["Extended Cost"] = np.select(
+        [df["Level"].eq(1), df["Level"].eq(0)],
+        ["background-color: lightblue", "background-color: yellow"],
+        default=""
+    )
+    return styles
+
+def pivot_purchase_orders(po_all):
+    """One row per item_number with its latest 3 POs spread across PO_COLUMNS."""
+    rank = po_all.groupby("item_number")["last_receipt_date"].rank(method="first", ascending=False)
+    latest = po_all.assign(rank=rank)[rank <= 3]
+    wide = latest.pivot(index="item_number", columns="rank", values=list(PO_FIELDS))
+    wide.columns = [PO_FIELDS[field].format(int(i)) for field, i in wide.columns]
+    return wide.reindex(columns=PO_COLUMNS).astype(PO_COLUMN_DTYPES)
 
 # --- BOM Hierarchy Construction ---
 def build_bom_hierarchy(df):
-    df = df[(df["Unit Cost"] > 0) & (df["Component Quantity"] > 0)].copy()
-    df["Extended Cost"] = df["Component Quantity"] * df["Unit Cost"]
-    df["B/M"] = df["B/M"].map({1: "Make", 2: "Buy"}).fillna("Unknown")
     top_items = df[df["Level"] == 1]["Item"].unique()
-    hierarchy_rows = []
+    top_unit_cost = df.groupby("Item")["Unit Cost"].sum()
+    top_ext_cost = df.groupby("Item")["Extended Cost"].sum()
+    columns = list(df.columns)
+    item_pos, component_pos = columns.index("Item"), columns.index("Component")
+    out_columns = columns + ["Display Component"]
 
-    def recurse(parent, level):
-        children = df[df["Item"] == parent]
-        for _, row in children.iterrows():
-            row_data = row.copy()
-            row_data["Display Component"] = f"{'    ' * level}-  {row['Component']}"
-            hierarchy_rows.append(row_data)
-            if level <= 2:
-                recurse(row["Component"], level + 1)
+    children_by_item = {}
+    for values in df.itertuples(index=False, name=None):
+        children_by_item.setdefault(values[item_pos], []).append(values)
 
+    hierarchy_rows = []
     for top in top_items:
-        pseudo_row = pd.Series({
+        pseudo_row = {
             "Level": 0, "Item": None, "Component": top, "Component Description": "Top-Level Assembly",
-            "Component Quantity": None, "Unit Cost": df[df["Item"] == top]["Unit Cost"].sum(),
-            "Extended Cost": df[df["Item"] == top]["Extended Cost"].sum(), "Parent": None,
-            "Display Component": top
-        })
-        hierarchy_rows.append(pseudo_row)
-        recurse(top, 1)
+            "Component Quantity": None, "Unit Cost": top_unit_cost.get(top, 0),
+            "Extended Cost": top_ext_cost.get(top, 0), "Display Component": top
+        }
+        hierarchy_rows.append(tuple(pseudo_row.get(col) for col in out_columns))
+
+        # Depth-first with an explicit stack; children are pushed reversed to keep BOM order
+        stack = [(values, 1) for values in reversed(children_by_item.get(top, ()))]
+        while stack:
+            values, level = stack.pop()
+            component = values[component_pos]
+            hierarchy_rows.append(values + (f"{'    ' * level}-  {component}",))
+            if level <= 2:
+                stack.extend((child, level + 1) for child in reversed(children_by_item.get(component, ())))
 
-    return pd.DataFrame(hierarchy_rows)
+    # from_records re-infers from plain tuples; restore the PO column dtypes
+    return pd.DataFrame.from_records(hierarchy_rows, columns=out_columns).astype(PO_COLUMN_DTYPES)
 
 # --- Prompt Building ---
 def build_prompt_from_group(group):
     item_id = group.iloc[0]['Component']
     item_desc = group.iloc[0]['Component Description']
-    records = [
-        "- " + " | ".join(f"{k}: {v}" for k, v in row.dropna().items())
-        for _, row in group.iterrows()
-    ]
-    details = "\n".join(records)
+    records = group.dropna(axis=1, how="all").to_dict(orient="records")
+    details = "\n".join(
+        "- " + " | ".join(f"{k}: {v}" for k, v in record.items() if pd.notna(v))
+        for record in records
+    )
     return f"""
     You are a pricing analyst AI. Your task is to analyze component-level estimates and calculate a reasonable total estimated cost for an assembly item.
 
@@ -88,20 +161,140 @@ def build_prompt_from_group(group):
     """
 
 # --- LLM Call ---
-def query_llm(prompt):
+def build_llm_request(prompt, model=LLM_MODEL):
+    """Chat-completions body shared by the streaming and batch paths."""
+    return {"model": model, "temperature": LLM_TEMPERATURE, "messages": [{"role": "user", "content": prompt}]}
+
+def stream_llm(prompt):
+    """Yield the completion for a prompt piece by piece as Azure generates it."""
     client = setup_azure_openai_client()
-    response = client.chat.completions.create(
-        temperature=0,
-        model="gpt-4o-pib",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    return response.choices[0].message.content.replace("$", "\\$")
+    with client.chat.completions.create(**build_llm_request(prompt), stream=True) as stream:
+        for chunk in stream:
+            # Azure sends a leading chunk with only content-filter results and no choices
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content.replace("$", "\\$")
+
+def open_llm_cache():
+    db = sqlite3.connect(LLM_CACHE_PATH)
+    db.execute("CREATE TABLE IF NOT EXISTS llm_cache (hash TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)")
+    return db
+
+def prompt_hash(prompt):
+    # Key on the model settings too, so a model change does not replay stale answers
+    key = f"{LLM_MODEL}\0{LLM_TEMPERATURE}\0{prompt}"
+    return hashlib.blake2b(key.encode("utf-8")).hexdigest()
+
+def load_cached_response(prompt):
+    with closing(open_llm_cache()) as db:
+        row = db.execute(
+            "SELECT response FROM llm_cache WHERE hash = ? AND created_at > ?",
+            (prompt_hash(prompt), time.time() - LLM_CACHE_TTL)
+        ).fetchone()
+    return row[0] if row else None
+
+def store_cached_response(prompt, response):
+    now = time.time()
+    with closing(open_llm_cache()) as db, db:
+        db.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - LLM_CACHE_TTL,))
+        db.execute(
+            "INSERT OR REPLACE INTO llm_cache (hash, response, created_at) VALUES (?, ?, ?)",
+            (prompt_hash(prompt), response, now)
+        )
+
+def collect_llm_stream(prompt, parts, cancelled):
+    """Append a prompt's analysis to parts as it streams, replaying cached analyses instantly.
+
+    Stops and closes the stream once the cancelled event is set.
+    """
+    response = load_cached_response(prompt)
+    if response:
+        parts.append(response)
+        return
+    with closing(stream_llm(prompt)) as pieces:
+        for piece in pieces:
+            if cancelled.is_set():
+                return
+            parts.append(piece)
+    # An empty completion (e.g. content-filtered) is not worth replaying
+    if parts:
+        store_cached_response(prompt, "".join(parts))
+
+def submit_llm_batch(prompts):
+    """Upload {custom_id: prompt} as a Batch API job and return the batch id."""
+    client = setup_azure_batch_client()
+    lines = [
+        json.dumps({
+            "custom_id": custom_id, "method": "POST", "url": "/chat/completions",
+            "body": build_llm_request(prompt, model=LLM_BATCH_MODEL),
+        })
+        for custom_id, prompt in prompts.items()
+    ]
+    batch_file = client.files.create(file=("level0_prompts.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    client.files.wait_for_processing(batch_file.id)
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/chat/completions", completion_window="24h")
+    return batch.id
+
+def wait_for_llm_batch(batch_id, timeout=BATCH_POLL_TIMEOUT):
+    """Poll a batch with exponential backoff until it finishes or the timeout passes."""
+    client = setup_azure_batch_client()
+    deadline = time.monotonic() + timeout
+    delay = 2
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_TERMINAL_STATUSES or time.monotonic() + delay > deadline:
+            return batch
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+
+def read_batch_file(client, file_id):
+    """Parse a Batch API JSONL file into records; a missing file id yields none."""
+    if file_id is None:
+        return []
+    return [json.loads(line) for line in client.files.content(file_id).text.splitlines() if line.strip()]
+
+def load_llm_batch_results(batch):
+    """Map every submitted custom_id of a completed batch to its response or failure notice."""
+    client = setup_azure_batch_client()
+    # The input file lists every prompt, so assemblies with no result still get an entry
+    results = {
+        record["custom_id"]: "_No result was returned for this assembly._"
+        for record in read_batch_file(client, batch.input_file_id)
+    }
+    for record in read_batch_file(client, batch.output_file_id) + read_batch_file(client, batch.error_file_id):
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            choice = response["body"]["choices"][0]
+            content = choice["message"].get("content")
+            if content:
+                results[record["custom_id"]] = content.replace("$", "\\$")
+            else:
+                # e.g. finish_reason == "content_filter" returns a null message
+                results[record["custom_id"]] = f"_No analysis was returned (finish reason: {choice.get('finish_reason')})._"
+        else:
+            results[record["custom_id"]] = f"Batch request failed: {record.get('error') or response.get('body')}"
+    return results
+
+def render_llm_batch(batch_id):
+    """Show a batch's analyses once it has completed, otherwise its current status."""
+    with st.spinner(f"Waiting for batch {batch_id}..."):
+        batch = wait_for_llm_batch(batch_id)
+    if batch.status != "completed":
+        st.info(f"Batch {batch_id} is {batch.status}. Use \"Check batch results\" to load it later.")
+        return
+    for component, response in load_llm_batch_results(batch).items():
+        with st.expander(f"Cost Analysis for {component}"):
+            st.markdown(response)
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="BOM Hierarchy Viewer", layout="wide")
 st.title("🔍 BOM Hierarchical Viewer with Cost Estimation")
 
 item_number = st.text_input("Enter Assembly Item Number (e.g., 10985296-001):")
+use_batch = st.checkbox("Use batch (async, cheaper)")
+
+# Restore a submitted batch after a page refresh
+if "batch_id" not in st.session_state and "batch_id" in st.query_params:
+    st.session_state["batch_id"] = st.query_params["batch_id"]
 
 if st.button("Search BOM"):
     if not item_number:
@@ -109,35 +302,26 @@ if st.button("Search BOM"):
     else:
         try:
             with st.spinner("Fetching BOM and PO data..."):
-                df = get_bom_structure(item_number)
-                for i in range(1, 4):
-                    df[f"PO {i}"] = df[f"PO Date {i}"] = df[f"Unit Price {i}"] = ""
-
-                components = df["Component"].dropna().astype(str).str.strip().unique()
-                po_info_dict = {}
-                for component in components:
-                    clean = normalize_component(component)
-                    if clean not in po_info_dict:
-                        po_info_dict[clean] = get_latest_purchase_orders(clean)
-
-                for i, row in df.iterrows():
-                    comp = normalize_component(str(row["Component"]))
-                    po_data = po_info_dict.get(comp)
-                    if po_data is not None and not po_data.empty:
-                        for idx, (_, po_row) in enumerate(po_data.iterrows()):
-                            idx1 = idx + 1
-                            df.at[i, f"PO {idx1}"] = po_row.get("po_number", "")
-                            df.at[i, f"PO Date {idx1}"] = po_row.get("last_receipt_date", "")
-                            df.at[i, f"Unit Price {idx1}"] = po_row.get("last_unit_price", "")
+                df = get_bom_structure_cached(item_number)
+                df["_component_clean"] = normalize_component(df["Component"])
+                clean_components = df.loc[df["Component"].notna(), "_component_clean"].unique().tolist()
+                po_all = get_latest_purchase_orders_cached(tuple(clean_components))
+
+                po_wide = pivot_purchase_orders(po_all).reindex(df["_component_clean"])
+                for col in PO_COLUMNS:
+                    df[col] = po_wide[col].array
+                df = df.drop(columns="_component_clean")
 
                 if df.empty:
                     st.info("No data found.")
                 else:
                     st.success(f"{len(df)} rows retrieved.")
                     df_result = build_bom_hierarchy(df).reset_index(drop=True)
-                    df_result["Percentage Est"] = df_result.apply(estimate_percentage, axis=1)
+                    df_result["Percentage Est"] = estimate_percentage(df_result)
                     df_result = df_result[df_result["Level"].isin([0, 1])].copy()
-                    df_result["Component Quantity"] = df_result["Component Quantity"].fillna(0).astype(int)
+                    df_result["Component Quantity"] = df_result["Component Quantity"].fillna(0).astype("Int32")
+                    df_result["Level"] = df_result["Level"].astype("int8")
+                    df_result[["B/M", "Percentage Est"]] = df_result[["B/M", "Percentage Est"]].astype("category")
 
                     for col in ["Unit Cost", "Extended Cost", "Unit Price 1", "Unit Price 2", "Unit Price 3"]:
                         df_result[col] = pd.to_numeric(df_result[col], errors="coerce").round(2)
@@ -149,7 +333,7 @@ if st.button("Search BOM"):
                             "PO 2", "PO Date 2", "Unit Price 2", "PO 3", "PO Date 3", "Unit Price 3", "Percentage Est"
                         ]]
                         .style
-                        .apply(highlight_extended_cost_level_1, axis=1)
+                        .apply(highlight_extended_cost_level_1, axis=None)
                         .format({
                             "Unit Cost": "{:.2f}", "Extended Cost": "{:.2f}",
                             "Unit Price 1": "{:.2f}", "Unit Price 2": "{:.2f}", "Unit Price 3": "{:.2f}"
@@ -159,15 +343,55 @@ if st.button("Search BOM"):
                     st.dataframe(styled_df, use_container_width=True)
                     st.subheader("📊 LLM-Based Cost Analysis")
 
-                    level_0_indices = df_result[df_result["Level"] == 0].index.tolist() + [len(df_result)]
-                    level_0_groups = [df_result.iloc[level_0_indices[i]:level_0_indices[i+1]] for i in range(len(level_0_indices) - 1)]
+                    level_0_groups = [group for _, group in df_result.groupby(df_result["Level"].eq(0).cumsum(), sort=False)]
+
+                    if use_batch:
+                        prompts = {group.iloc[0]["Component"]: build_prompt_from_group(group) for group in level_0_groups}
+                        with st.spinner(f"Submitting batch for {len(prompts)} assemblies..."):
+                            batch_id = submit_llm_batch(prompts)
+                        st.session_state["batch_id"] = st.query_params["batch_id"] = batch_id
+                        render_llm_batch(batch_id)
+                    else:
+                        prompts = [build_prompt_from_group(group) for group in level_0_groups]
+                        placeholders = []
+                        for group in level_0_groups:
+                            with st.expander(f"Cost Analysis for {group.iloc[0]['Component']}"):
+                                placeholders.append(st.empty())
+                            placeholders[-1].caption("Analyzing...")
 
-                    for group in level_0_groups:
-                        prompt = build_prompt_from_group(group)
-                        with st.spinner(f"Analyzing: {group.iloc[0]['Component']}..."):
-                            response = query_llm(prompt)
-                        with st.expander(f"Cost Analysis for {group.iloc[0]['Component']}"):
-                            st.markdown(response)
+                        # Workers fill these buffers; only the script thread touches the placeholders
+                        streamed = [[] for _ in prompts]
+                        rendered = [0] * len(prompts)
+                        cancelled = threading.Event()
+                        with st.spinner(f"Analyzing {len(prompts)} assemblies..."):
+                            executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY)
+                            try:
+                                futures = [executor.submit(collect_llm_stream, p, parts, cancelled) for p, parts in zip(prompts, streamed)]
+                                pending = set(futures)
+                                while pending:
+                                    _, pending = wait(pending, timeout=STREAM_REFRESH_INTERVAL)
+                                    for i, parts in enumerate(streamed):
+                                        if len(parts) > rendered[i]:
+                                            rendered[i] = len(parts)
+                                            placeholders[i].markdown("".join(parts[:rendered[i]]))
+                                for future in futures:
+                                    future.result()
+                            except BaseException:
+                                # A widget click raises Streamlit's rerun/stop exception here; stop
+                                # spending tokens on a page the user has left
+                                cancelled.set()
+                                executor.shutdown(wait=False, cancel_futures=True)
+                                raise
+                            executor.shutdown()
+                        for placeholder, parts in zip(placeholders, streamed):
+                            if not parts:
+                                placeholder.warning("No analysis was returned for this assembly.")
 
         except Exception as e:
             st.error(f"Error: {e}")
+
+if "batch_id" in st.session_state and st.button("Check batch results"):
+    try:
+        render_llm_batch(st.session_state["batch_id"])
+    except Exception as e:
+        st.error(f"Error: {e}")
@@ -1,6 +1,10 @@
 import pandas as pd
+import pyarrow
 import oracledb
 import os
+import time
+import threading
+from functools import wraps
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -10,30 +14,84 @@ load_dotenv()
 oracle_client_path = "/home/ec2-user/rig/instantclient-basic-linux.x64-23.8.0.25.04/instantclient_23_8/"
 oracledb.init_oracle_client(lib_dir=oracle_client_path)
 
+# Keep parsed statements cached on every pooled connection
+oracledb.defaults.stmtcachesize = 40
+
+# Transient network errors worth retrying (connect timeout, lost connection)
+RETRYABLE_ORA_CODES = {12170, 3113, 3135, 3136}
+
+# Oracle rejects IN lists with more than 1000 expressions
+IN_LIST_LIMIT = 1000
+
+PO_RESULT_COLUMNS = ["item_number", "po_number", "last_receipt_date", "last_unit_price", "vendor_name", "rank_by_po"]
+
+def retry_on_timeout(func, retries=3, backoff=0.5):
+    """Retry a query on transient Oracle network errors with exponential backoff."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except oracledb.DatabaseError as e:
+                code = getattr(e.args[0], "code", None) if e.args else None
+                if attempt == retries or code not in RETRYABLE_ORA_CODES:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+    return wrapper
+
+def bind_bucket(count: int) -> int:
+    """Round an IN-list length up to a power of two so chunks reuse the same SQL text."""
+    return min(1 << (count - 1).bit_length(), IN_LIST_LIMIT)
+
+# Session pool shared by all queries; created on first use so a database
+# outage surfaces as a query error rather than an import failure
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the shared session pool, creating it on first call."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = oracledb.create_pool(
+                user=os.getenv("DB_USERNAME"),
+                password=os.getenv("DB_PASSWORD"),
+                dsn=f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_SERVICE_NAME')}",
+                min=2,
+                max=16,
+                increment=2,
+                getmode=oracledb.POOL_GETMODE_WAIT
+            )
+        return _pool
+
 def create_connection():
-    """Establish Oracle DB connection using environment variables."""
-    dsn = f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_SERVICE_NAME')}"
-    return oracledb.connect(
-        user=os.getenv("DB_USERNAME"),
-        password=os.getenv("DB_PASSWORD"),
-        dsn=dsn
-    )
+    """Acquire an Oracle DB connection from the shared session pool."""
+    return get_pool().acquire()
+
+def fetch_dataframe(query: str, parameters, arraysize: int) -> pd.DataFrame:
+    """Run a query straight into Arrow and convert to pandas without a Python row list."""
+    with create_connection() as connection:
+        odf = connection.fetch_df_all(statement=query, parameters=parameters, arraysize=arraysize)
+        return pyarrow.table(odf).to_pandas()
 
+@retry_on_timeout
 def get_bom_structure(item_number: str) -> pd.DataFrame:
     """
     Retrieves the hierarchical Bill of Materials for a given assembly item number.
-    Filters for effective components and includes cost and description data.
+    Filters for effective components with a non-zero quantity and cost, and
+    includes extended cost, make/buy and description data.
     """
-    query = f"""
+    query = """
     SELECT
-        LEVEL AS "Level",
+        CAST(LEVEL AS NUMBER(3)) AS "Level",
         xbev.assembly_item AS "Item",
         xbev.to_level_item_desc AS "Description",
         xbev.component_item AS "Component",
-        xbev.make_buy_code AS "B/M",
+        CASE xbev.make_buy_code WHEN 1 THEN 'Make' WHEN 2 THEN 'Buy' ELSE 'Unknown' END AS "B/M",
         xbev.component_description AS "Component Description",
         ROUND(xbev.component_quantity) AS "Component Quantity",
-        ROUND(xbev.item_cost, 2) AS "Unit Cost"
+        ROUND(xbev.item_cost, 2) AS "Unit Cost",
+        ROUND(ROUND(xbev.component_quantity) * ROUND(xbev.item_cost, 2), 2) AS "Extended Cost"
     FROM (
         SELECT DISTINCT
             bom.assembly_item_id,
@@ -59,48 +117,61 @@ def get_bom_structure(item_number: str) -> pd.DataFrame:
             JOIN apps.org_organization_definitions ood2 ON ood2.organization_id = msib2.organization_id
         WHERE
             SYSDATE BETWEEN bic.effectivity_date AND NVL(bic.disable_date, SYSDATE)
+            AND ROUND(bic.component_quantity) > 0
+            AND ROUND(cic.item_cost, 2) > 0
     ) xbev
-    START WITH xbev.assembly_item = '{item_number}'
+    START WITH xbev.assembly_item = :item_number
     CONNECT BY NOCYCLE PRIOR xbev.component_item = xbev.assembly_item
     ORDER BY LEVEL
     """
-    with create_connection().cursor() as cursor:
-        cursor.execute(query)
-        columns = [col[0] for col in cursor.description]
-        rows = cursor.fetchall()
-    return pd.DataFrame(rows, columns=columns).drop_duplicates()
+    return fetch_dataframe(query, {"item_number": item_number}, arraysize=500).drop_duplicates()
 
 def get_latest_purchase_orders(item_number: str) -> pd.DataFrame:
     """
     Retrieves the latest 3 purchase orders for a given item_number.
     Includes PO number, vendor, receipt date, and unit price.
     """
-    query = f"""
-    SELECT * FROM (
-        SELECT
-            msi.segment1 AS item_number,
-            ph.segment1 AS po_number,
-            MAX(rt.transaction_date) AS last_receipt_date,
-            MAX(rt.po_unit_price) AS last_unit_price,
-            sup.vendor_name,
-            DENSE_RANK() OVER (ORDER BY MAX(rt.transaction_date) DESC) AS rank_by_po
-        FROM
-            INV.mtl_system_items_b msi
-            JOIN PO.po_lines_all pol ON msi.inventory_item_id = pol.item_id
-            JOIN PO.rcv_transactions rt ON rt.po_line_id = pol.po_line_id
-            JOIN PO.po_headers_all ph ON rt.po_header_id = ph.po_header_id
-            JOIN AP.ap_suppliers sup ON ph.vendor_id = sup.vendor_id
-        WHERE
-            msi.segment1 = '{item_number}'
-            AND rt.transaction_type = 'RECEIVE'
-            AND rt.po_unit_price IS NOT NULL
-        GROUP BY
-            msi.segment1, ph.segment1, sup.vendor_name
-    ) WHERE rank_by_po <= 3
-    ORDER BY last_receipt_date DESC
+    return get_latest_purchase_orders_bulk([item_number])
+
+@retry_on_timeout
+def get_latest_purchase_orders_bulk(item_numbers: list[str]) -> pd.DataFrame:
+    """
+    Retrieves the latest 3 purchase orders for each of the given item numbers
+    in one query per chunk of IN_LIST_LIMIT items, as one long DataFrame
+    ordered by item_number and most recent receipt first.
     """
-    with create_connection().cursor() as cursor:
-        cursor.execute(query)
-        columns = [col[0] for col in cursor.description]
-        rows = cursor.fetchall()
-    return pd.DataFrame(rows, columns=columns).rename(columns=str.lower)
+    frames = []
+    for start in range(0, len(item_numbers), IN_LIST_LIMIT):
+        chunk = item_numbers[start:start + IN_LIST_LIMIT]
+        # Pad with a repeated item; duplicates in an IN list do not change the result
+        chunk = chunk + [chunk[-1]] * (bind_bucket(len(chunk)) - len(chunk))
+        binds = ", ".join(f":{i + 1}" for i in range(len(chunk)))
+        query = f"""
+        SELECT * FROM (
+            SELECT
+                msi.segment1 AS item_number,
+                ph.segment1 AS po_number,
+                MAX(rt.transaction_date) AS last_receipt_date,
+                MAX(rt.po_unit_price) AS last_unit_price,
+                sup.vendor_name,
+                DENSE_RANK() OVER (PARTITION BY msi.segment1 ORDER BY MAX(rt.transaction_date) DESC) AS rank_by_po
+            FROM
+                INV.mtl_system_items_b msi
+                JOIN PO.po_lines_all pol ON msi.inventory_item_id = pol.item_id
+                JOIN PO.rcv_transactions rt ON rt.po_line_id = pol.po_line_id
+                JOIN PO.po_headers_all ph ON rt.po_header_id = ph.po_header_id
+                JOIN AP.ap_suppliers sup ON ph.vendor_id = sup.vendor_id
+            WHERE
+                msi.segment1 IN ({binds})
+                AND rt.transaction_type = 'RECEIVE'
+                AND rt.po_unit_price IS NOT NULL
+            GROUP BY
+                msi.segment1, ph.segment1, sup.vendor_name
+        ) WHERE rank_by_po <= 3
+        ORDER BY item_number, last_receipt_date DESC
+        """
+        frames.append(fetch_dataframe(query, chunk, arraysize=1000).rename(columns=str.lower))
+
+    if not frames:
+        return pd.DataFrame(columns=PO_RESULT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)